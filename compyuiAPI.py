@@ -1,347 +1,752 @@
-import requests
-import json
-import time
-import os
-from typing import Dict, Any, List, Optional
-
-class ComfyUIAPI:
-    def __init__(self, server_address: str = "http://127.0.0.1:8188"):
-        """ComfyUI API 클라이언트 초기화
-
-        Args:
-            server_address: ComfyUI 서버 주소 (기본값: http://127.0.0.1:8188)
-        """
-        self.server_address = server_address
-        self.history_data = {}
-    
-    def load_workflow(self, workflow_path: str) -> Dict[str, Any]:
-        """워크플로우 JSON 파일 로드
-
-        Args:
-            workflow_path: 워크플로우 JSON 파일 경로
-
-        Returns:
-            Dict: 로드된 워크플로우 데이터
-        """
-        with open(workflow_path, "r", encoding="utf-8") as file:
-            return json.load(file)
-    
-    def update_node_input(self, workflow: Dict[str, Any], node_id: str, input_name: str, new_value: Any) -> Dict[str, Any]:
-        """워크플로우의 특정 노드의 입력값 업데이트
-
-        Args:
-            workflow: 워크플로우 데이터
-            node_id: 업데이트할 노드 ID (문자열)
-            input_name: 업데이트할 입력 파라미터 이름
-            new_value: 새 입력값
-
-        Returns:
-            Dict: 업데이트된 워크플로우 데이터
-        """
-        if node_id in workflow:
-            if input_name in workflow[node_id]["inputs"]:
-                workflow[node_id]["inputs"][input_name] = new_value
-                print(f"노드 {node_id}의 {input_name} 값을 업데이트했습니다.")
-            else:
-                print(f"경고: 노드 {node_id}에 {input_name} 입력이 없습니다.")
-        else:
-            print(f"경고: 워크플로우에 노드 {node_id}가 없습니다.")
-        
-        return workflow
-    
-    def run_workflow(self, workflow: Dict[str, Any], client_id: Optional[str] = None) -> str:
-        """워크플로우 실행
-
-        Args:
-            workflow: 실행할 워크플로우 데이터
-            client_id: 클라이언트 ID (옵션)
-
-        Returns:
-            str: 프롬프트 ID
-        """
-        # API 형식에 맞게 요청 데이터 구성
-        prompt_data = {
-            "prompt": workflow,
-            "client_id": client_id if client_id else ""
-        }
-        
-        # 워크플로우 실행 요청
-        response = requests.post(f"{self.server_address}/prompt", json=prompt_data)
-        
-        if response.status_code != 200:
-            raise Exception(f"워크플로우 실행 실패: {response.status_code}, {response.text}")
-        
-        result = response.json()
-        print(f"응답 데이터: {result}")
-        
-        # prompt_id 추출 (ComfyUI 버전에 따라 다를 수 있음)
-        prompt_id = ""
-        if "prompt_id" in result:
-            prompt_id = result["prompt_id"]
-        elif "id" in result:
-            prompt_id = result["id"]
-        elif isinstance(result, list) and len(result) > 0:
-            prompt_id = str(result[0])
-        
-        if not prompt_id:
-            raise Exception(f"프롬프트 ID를 찾을 수 없습니다: {result}")
-        
-        print(f"워크플로우 실행 시작됨, 프롬프트 ID: {prompt_id}")
-        return prompt_id
-    
-    def wait_for_completion(self, prompt_id: str, check_interval: float = 1.0) -> bool:
-        """워크플로우 실행 완료 대기
-
-        Args:
-            prompt_id: 기다릴 프롬프트 ID
-            check_interval: 상태 확인 간격(초)
-
-        Returns:
-            bool: 실행 성공 여부
-        """
-        print("실행 완료 대기 중...")
-        while True:
-            # 큐 상태 확인
-            response = requests.get(f"{self.server_address}/queue")
-            
-            if response.status_code != 200:
-                print(f"큐 상태 확인 실패: {response.status_code}")
-                time.sleep(check_interval)
-                continue
-            
-            queue_data = response.json()
-            
-            # 디버깅을 위해 큐 데이터 구조 출력
-            # print("큐 데이터 구조:", json.dumps(queue_data, indent=2))
-            
-            # ComfyUI 큐 데이터 구조 처리
-            running_prompts = []
-            pending_prompts = []
-            
-            # 큐 데이터 구조 확인 및 처리
-            if "queue_running" in queue_data:
-                if isinstance(queue_data["queue_running"], list):
-                    for item in queue_data["queue_running"]:
-                        if isinstance(item, dict) and "prompt_id" in item:
-                            running_prompts.append(item["prompt_id"])
-                        elif isinstance(item, list) and len(item) > 0:
-                            running_prompts.append(item[0])  # 첫 번째 요소가 prompt_id일 수 있음
-            
-            if "queue_pending" in queue_data:
-                if isinstance(queue_data["queue_pending"], list):
-                    for item in queue_data["queue_pending"]:
-                        if isinstance(item, dict) and "prompt_id" in item:
-                            pending_prompts.append(item["prompt_id"])
-                        elif isinstance(item, list) and len(item) > 0:
-                            pending_prompts.append(item[0])  # 첫 번째 요소가 prompt_id일 수 있음
-            
-            print(f"실행 중인 작업: {running_prompts}")
-            print(f"대기 중인 작업: {pending_prompts}")
-            
-            # 해당 프롬프트가 큐에 없고 처리 중인 작업도 없으면 완료로 간주
-            if prompt_id not in running_prompts and prompt_id not in pending_prompts:
-                if not running_prompts:
-                    print("워크플로우 실행 완료!")
-                    return True
-            
-            # 아직 완료되지 않았으면 대기
-            time.sleep(check_interval)
-    
-    def get_history(self, prompt_id: str) -> Dict[str, Any]:
-        """특정 프롬프트의 실행 결과 이력 조회
-
-        Args:
-            prompt_id: 조회할 프롬프트 ID
-
-        Returns:
-            Dict: 이력 데이터
-        """
-        response = requests.get(f"{self.server_address}/history")
-        
-        if response.status_code != 200:
-            raise Exception(f"이력 조회 실패: {response.status_code}")
-        
-        history = response.json()
-        self.history_data = history
-        
-        if prompt_id in history:
-            return history[prompt_id]
-        else:
-            print(f"경고: 프롬프트 ID {prompt_id}에 대한 이력이 없습니다.")
-            return {}
-    
-    def download_images(self, prompt_id: str, output_dir: str = "output") -> List[str]:
-        """생성된 이미지 다운로드
-
-        Args:
-            prompt_id: 이미지를 생성한 프롬프트 ID
-            output_dir: 이미지를 저장할 디렉토리
-
-        Returns:
-            List[str]: 다운로드된 이미지 파일 경로 목록
-        """
-        # 이력 조회
-        history = self.get_history(prompt_id)
-        
-        if not history or "outputs" not in history:
-            print(f"경고: 프롬프트 ID {prompt_id}에 대한 출력이 없습니다.")
-            return []
-        
-        # 출력 디렉토리 생성
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # 이미지 다운로드
-        downloaded_files = []
-        outputs = history.get("outputs", {})
-        
-        for node_id, node_output in outputs.items():
-            for output_type, output_data in node_output.items():
-                if output_type == "images":
-                    for image_data in output_data:
-                        filename = image_data.get("filename", "")
-                        if filename:
-                            # 이미지 파일 다운로드
-                            image_url = f"{self.server_address}/view?filename={filename}"
-                            local_path = os.path.join(output_dir, os.path.basename(filename))
-                            
-                            response = requests.get(image_url)
-                            if response.status_code == 200:
-                                with open(local_path, "wb") as file:
-                                    file.write(response.content)
-                                
-                                print(f"이미지 다운로드 완료: {local_path}")
-                                downloaded_files.append(local_path)
-                            else:
-                                print(f"이미지 다운로드 실패: {filename}, 상태 코드: {response.status_code}")
-        
-        return downloaded_files
-
-
-# 메인 실행 코드
-if __name__ == "__main__":
-    try:
-        # ComfyUI API 클라이언트 초기화
-        api = ComfyUIAPI("http://127.0.0.1:8188")  # 서버 주소 확인
-        print("ComfyUI API 클라이언트가 초기화되었습니다.")
-        
-        # 워크플로우 파일 경로 확인
-        workflow_path = "FluxAPi.json"
-        print(f"워크플로우 파일 '{workflow_path}' 로드 중...")
-        
-        # 워크플로우 로드
-        try:
-            workflow = api.load_workflow(workflow_path)
-            print("워크플로우 로드 성공!")
-        except Exception as e:
-            print(f"워크플로우 로드 실패: {e}")
-            print(f"현재 작업 디렉토리: {os.getcwd()}")
-            print(f"파일 존재 여부: {os.path.exists(workflow_path)}")
-            raise
-        
-        # 테스트 실행을 위한 스토리 설명 목록
-        # stories 폴더 내 JSON 파일 로드
-        stories_folder = "stories"
-        story_descriptions = []
-
-        if os.path.exists(stories_folder) and os.path.isdir(stories_folder):
-            for filename in os.listdir(stories_folder):
-                if filename.endswith(".json"):
-                    file_path = os.path.join(stories_folder, filename)
-                    try:
-                        with open(file_path, "r", encoding="utf-8") as file:
-                            story_data = json.load(file)
-                            if isinstance(story_data, dict) and "pages" in story_data:
-                                for page in story_data["pages"]:
-                                    if "image" in page:
-                                        story_descriptions.append(page["image"])
-                            else:
-                                print(f"경고: 파일 {filename}에 'pages' 키가 없거나 올바르지 않습니다.")
-                    except Exception as e:
-                        print(f"파일 {filename} 로드 중 오류 발생: {e}")
-        else:
-            print(f"경고: '{stories_folder}' 폴더가 존재하지 않습니다.")
-        # story_descriptions = [
-        #     "작은 별 반짝이가 혼자서는 빛이 약해 슬펐지만, 친구들과 함께 모여 밝게 빛나게 되었어요.",
-        #     "용감한 토끼 동동이가 숲속 친구들을 도와 겨울을 준비하는 이야기입니다.",
-        #     "마법의 연필을 발견한 소녀가 그림으로 세상을 바꾸는 모험을 떠납니다.",
-        #     "바다 속 작은 물고기가 플라스틱 쓰레기를 치우며 바다를 깨끗하게 만드는 환경 이야기",
-        #     "하늘을 날고 싶었던 작은 거북이의 끈기와 노력으로 꿈을 이루는 감동적인 모험"
-        # ]
-        
-        # 첫 번째 설명만 테스트로 실행
-        print(f"\n===== 테스트 실행 =====")
-        print(f"설명: {story_descriptions[0]}")
-        
-        # 워크플로우 복사 (원본 유지를 위해)
-        current_workflow = workflow.copy()
-        
-        # 노드 32의 텍스트 입력 업데이트
-        current_workflow = api.update_node_input(current_workflow, "32", "text", story_descriptions[0])
-        
-        # 워크플로우 실행
-        try:
-            prompt_id = api.run_workflow(current_workflow)
-            print(f"워크플로우 실행 요청 성공, ID: {prompt_id}")
-        except Exception as e:
-            print(f"워크플로우 실행 요청 실패: {e}")
-            raise
-            
-        # 완료 대기
-        try:
-            api.wait_for_completion(prompt_id)
-        except Exception as e:
-            print(f"워크플로우 완료 대기 실패: {e}")
-            raise
-            
-        # 이미지 다운로드
-        output_dir = "output/test"
-        try:
-            downloaded_files = api.download_images(prompt_id, output_dir)
-            print(f"생성된 이미지: {len(downloaded_files)}개")
-            for file in downloaded_files:
-                print(f" - {file}")
-        except Exception as e:
-            print(f"이미지 다운로드 실패: {e}")
-            
-        print("===== 테스트 실행 완료 =====\n")
-        
-        # 첫 번째 테스트가 성공하면 나머지 실행
-        print("첫 번째 테스트가 성공했습니다. 나머지 설명으로 계속하시겠습니까? (y/n)")
-        response = 'y'
-        
-        if response == 'y':
-            # 나머지 설명으로 이미지 생성
-            for i, description in enumerate(story_descriptions[1:], 1):
-                print(f"\n===== 스토리 {i+1} 이미지 생성 시작 =====")
-                print(f"설명: {description}")
-                
-                # 워크플로우 복사 (원본 유지를 위해)
-                current_workflow = workflow.copy()
-                
-                # 노드 32의 텍스트 입력 업데이트
-                current_workflow = api.update_node_input(current_workflow, "32", "text", description)
-                
-                # 워크플로우 실행
-                prompt_id = api.run_workflow(current_workflow)
-                
-                # 완료 대기
-                api.wait_for_completion(prompt_id)
-                
-                # 이미지 다운로드
-                output_dir = f"output/story_{i+1}"
-                downloaded_files = api.download_images(prompt_id, output_dir)
-                
-                print(f"생성된 이미지: {len(downloaded_files)}개")
-                for file in downloaded_files:
-                    print(f" - {file}")
-                
-                print(f"===== 스토리 {i+1} 이미지 생성 완료 =====\n")
-                
-                # 요청 간격 두기 (서버 부하 방지)
-                if i < len(story_descriptions) - 1:
-                    time.sleep(2)
-    
-    except Exception as e:
-        print(f"오류 발생: {e}")
-        import traceback
-        traceback.print_exc()
\ No newline at end of file
+import aiohttp
+import asyncio
+import ijson
+import io
+import json
+import logging
+import orjson
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+# 이력 캐시 유효 시간(초)
+HISTORY_CACHE_TTL = 24 * 60 * 60
+
+# 일시적 오류 재시도 설정 (모델 로드 중 발생하는 502/503 등)
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# WebSocket 이벤트 대기 중 이력을 재확인하는 간격(초)
+WS_RECHECK_INTERVAL = 5.0
+
+class ComfyUIAPI:
+    def __init__(self, server_address: str = "http://127.0.0.1:8188", batch_endpoint: Optional[str] = None):
+        """ComfyUI API 클라이언트 초기화
+
+        Args:
+            server_address: ComfyUI 서버 주소 (기본값: http://127.0.0.1:8188)
+            batch_endpoint: 일괄 제출용 게이트웨이 엔드포인트 경로
+                (예: "/apisix/batch-requests", 없으면 항상 순차 제출)
+        """
+        self.server_address = server_address
+        self.batch_endpoint = batch_endpoint
+        self.history_data = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        # 이미지 조회 엔드포인트 (쿼리 문자열만 요청마다 달라짐)
+        self._view_base = f"{server_address}/view"
+        # WebSocket 이벤트 구독에 사용할 클라이언트 ID (프롬프트 제출 시 함께 전달)
+        self.client_id = str(uuid.uuid4())
+        # 공유 WebSocket 리스너와 프롬프트 ID별 완료 대기 future
+        # (ComfyUI는 clientId당 소켓을 하나만 유지하므로 연결을 나눠 씀)
+        self._ws_listener: Optional[asyncio.Task] = None
+        self._ws_waiters: Dict[str, asyncio.Future] = {}
+        # 프롬프트 ID별 이력 캐시 ({prompt_id: (저장 시각, 이력 데이터)})
+        self._history_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        # 파싱된 워크플로우 캐시 ({(경로, 수정 시각): 워크플로우 데이터})
+        self._workflow_cache: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        # 첫 /prompt 응답에서 확정하는 prompt_id 추출 함수 (서버별 스키마 1회 감지)
+        self._extract_prompt_id: Optional[Callable[[Any], str]] = None
+
+    async def __aenter__(self) -> "ComfyUIAPI":
+        """비동기 컨텍스트 진입 시 HTTP 세션 생성 (모든 요청에서 재사용)
+
+        keep-alive 연결 풀을 사용하므로 폴링과 이미지 다운로드가
+        매번 새 TCP 연결을 맺지 않고 기존 연결을 재사용합니다.
+        """
+        connector = aiohttp.TCPConnector(limit=64, limit_per_host=16, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        """비동기 컨텍스트 종료 시 HTTP 세션 정리"""
+        await self.close()
+
+    async def close(self) -> None:
+        """WebSocket 리스너, HTTP 세션, 연결 풀 종료"""
+        if self._ws_listener is not None:
+            self._ws_listener.cancel()
+            try:
+                await self._ws_listener
+            except asyncio.CancelledError:
+                pass
+            self._ws_listener = None
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request_with_retry(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        """일시적 오류를 지수 백오프로 재시도하며 HTTP 요청 수행
+
+        연결 오류와 429/5xx 응답을 최대 RETRY_TOTAL회까지 재시도합니다.
+        대기 시간은 RETRY_BACKOFF_FACTOR에서 시작해 매번 2배로 늘고
+        지터가 더해지며, 서버가 Retry-After 헤더를 보내면 그 값을
+        우선합니다.
+
+        Args:
+            method: HTTP 메서드
+            url: 요청 URL
+            **kwargs: 세션 요청에 전달할 추가 인자
+
+        Returns:
+            aiohttp.ClientResponse: 마지막 응답
+        """
+        delay = RETRY_BACKOFF_FACTOR
+        for attempt in range(RETRY_TOTAL):
+            last_attempt = attempt == RETRY_TOTAL - 1
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except aiohttp.ClientError:
+                if last_attempt:
+                    raise
+            else:
+                if response.status not in RETRY_STATUSES or last_attempt:
+                    return response
+
+                logger.warning(
+                    "요청 실패(%s %s, 상태 %s), %.1f초 후 재시도합니다.",
+                    method, url, response.status, delay,
+                )
+                retry_after = response.headers.get("Retry-After")
+                response.release()
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            delay *= 2
+
+    def load_workflow(self, workflow_path: str) -> Dict[str, Any]:
+        """워크플로우 JSON 파일 로드
+
+        파일 경로와 수정 시각을 키로 파싱 결과를 캐시하므로, 같은
+        파일을 다시 로드해도 파일이 바뀌지 않았다면 재파싱하지 않습니다.
+
+        Args:
+            workflow_path: 워크플로우 JSON 파일 경로
+
+        Returns:
+            Dict: 로드된 워크플로우 데이터
+        """
+        cache_key = (workflow_path, os.stat(workflow_path).st_mtime_ns)
+        workflow = self._workflow_cache.get(cache_key)
+
+        if workflow is None:
+            # orjson은 bytes를 바로 받으므로 UTF-8 디코딩 단계가 생략됨
+            with open(workflow_path, "rb") as file:
+                workflow = orjson.loads(file.read())
+            self._workflow_cache[cache_key] = workflow
+
+        return workflow
+
+    def update_node_input(self, workflow: Dict[str, Any], node_id: str, input_name: str, new_value: Any) -> Dict[str, Any]:
+        """워크플로우의 특정 노드의 입력값 업데이트
+
+        Args:
+            workflow: 워크플로우 데이터
+            node_id: 업데이트할 노드 ID (문자열)
+            input_name: 업데이트할 입력 파라미터 이름
+            new_value: 새 입력값
+
+        Returns:
+            Dict: 업데이트된 워크플로우 데이터 (원본은 변경되지 않음)
+        """
+        node = workflow.get(node_id)
+        if node is not None:
+            inputs = node.get("inputs", {})
+            if input_name in inputs:
+                # 변경되는 노드만 새로 만들고 나머지 노드는 원본과 공유
+                updated = {
+                    **workflow,
+                    node_id: {**node, "inputs": {**inputs, input_name: new_value}},
+                }
+                logger.debug("노드 %s의 %s 값을 업데이트했습니다.", node_id, input_name)
+                return updated
+            else:
+                logger.warning("경고: 노드 %s에 %s 입력이 없습니다.", node_id, input_name)
+        else:
+            logger.warning("경고: 워크플로우에 노드 %s가 없습니다.", node_id)
+
+        return workflow
+
+    async def run_workflow(self, workflow: Dict[str, Any], client_id: Optional[str] = None) -> str:
+        """워크플로우 실행
+
+        Args:
+            workflow: 실행할 워크플로우 데이터
+            client_id: 클라이언트 ID (옵션)
+
+        Returns:
+            str: 프롬프트 ID
+        """
+        # API 형식에 맞게 요청 데이터 구성
+        prompt_data = {
+            "prompt": workflow,
+            "client_id": client_id if client_id else self.client_id
+        }
+
+        # 워크플로우 실행 요청 (일시적 오류는 백오프 후 재시도)
+        response = await self._request_with_retry("POST", f"{self.server_address}/prompt", json=prompt_data)
+        async with response:
+            response.raise_for_status()
+            result = await response.json()
+        logger.debug("응답 데이터: %s", result)
+
+        # prompt_id 추출 (ComfyUI 버전에 따라 다를 수 있음)
+        # 첫 응답에서 스키마를 확정해 두고 이후 호출은 추출 함수 하나만 거침
+        prompt_id = ""
+        if self._extract_prompt_id is not None:
+            try:
+                prompt_id = self._extract_prompt_id(result)
+            except (KeyError, IndexError, TypeError):
+                # 스키마가 예상과 달라졌으면 다시 감지
+                self._extract_prompt_id = None
+
+        if not prompt_id:
+            if isinstance(result, dict) and "prompt_id" in result:
+                self._extract_prompt_id = lambda r: r["prompt_id"]
+            elif isinstance(result, dict) and "id" in result:
+                self._extract_prompt_id = lambda r: r["id"]
+            elif isinstance(result, list) and len(result) > 0:
+                self._extract_prompt_id = lambda r: str(r[0])
+
+            if self._extract_prompt_id is not None:
+                prompt_id = self._extract_prompt_id(result)
+
+        if not prompt_id:
+            raise Exception(f"프롬프트 ID를 찾을 수 없습니다: {result}")
+
+        logger.info("워크플로우 실행 시작됨, 프롬프트 ID: %s", prompt_id)
+        return prompt_id
+
+    async def run_workflows_batch(self, workflows: List[Dict[str, Any]], batch_endpoint: Optional[str] = None) -> List[str]:
+        """여러 워크플로우를 한 번의 HTTP 요청으로 일괄 제출
+
+        APISIX 등의 게이트웨이가 제공하는 batch-requests 엔드포인트로
+        /prompt 요청들을 파이프라인으로 묶어 보내, 제출 N회의 왕복
+        비용을 1회로 줄입니다. 일괄 엔드포인트는 생성자나 인자로
+        설정했을 때만 사용하며, 설정하지 않으면(일반 ComfyUI 서버)
+        같은 keep-alive 연결로 바로 순차 제출합니다.
+
+        Args:
+            workflows: 실행할 워크플로우 데이터 목록
+            batch_endpoint: 게이트웨이의 일괄 요청 엔드포인트 경로
+                (기본값: 생성자에 설정한 batch_endpoint)
+
+        Returns:
+            List[str]: 제출 순서대로의 프롬프트 ID 목록
+        """
+        batch_endpoint = batch_endpoint or self.batch_endpoint
+        if batch_endpoint is None:
+            # 일괄 엔드포인트 미설정: 같은 keep-alive 연결로 순차 제출
+            return [await self.run_workflow(workflow) for workflow in workflows]
+
+        pipeline = [
+            {
+                "method": "POST",
+                "path": "/prompt",
+                "body": json.dumps({"prompt": workflow, "client_id": self.client_id}),
+            }
+            for workflow in workflows
+        ]
+
+        try:
+            async with self.session.post(
+                f"{self.server_address}{batch_endpoint}", json={"pipeline": pipeline}
+            ) as response:
+                if response.status == 200:
+                    entries = await response.json()
+                    prompt_ids = []
+                    for entry in entries:
+                        body = entry.get("body", "") if isinstance(entry, dict) else ""
+                        result = json.loads(body) if isinstance(body, str) and body else body or {}
+                        prompt_id = result.get("prompt_id") or result.get("id") or ""
+                        if not prompt_id:
+                            raise Exception(f"프롬프트 ID를 찾을 수 없습니다: {entry}")
+                        prompt_ids.append(prompt_id)
+
+                    logger.info("워크플로우 %d개 일괄 제출 완료", len(prompt_ids))
+                    return prompt_ids
+
+                logger.warning("일괄 제출 실패(%s), 순차 제출로 대체합니다.", response.status)
+        except aiohttp.ClientError as e:
+            logger.warning("일괄 제출 엔드포인트 사용 불가, 순차 제출로 대체합니다: %s", e)
+
+        # 같은 keep-alive 연결로 순차 제출 (연결 비용은 1회만 발생)
+        return [await self.run_workflow(workflow) for workflow in workflows]
+
+    async def wait_for_completion(self, prompt_id: str) -> bool:
+        """워크플로우 실행 완료 대기
+
+        인스턴스가 공유하는 WebSocket 리스너에 완료 future를 등록하고
+        이벤트를 기다립니다. ComfyUI는 clientId당 소켓을 하나만 유지
+        하므로(새 연결이 기존 연결을 대체) 대기마다 연결을 새로 열지
+        않고 리스너 하나가 모든 대기자에게 이벤트를 분배합니다.
+        소켓이 조용한 동안에도 주기적으로 이력을 재확인해 이벤트를
+        놓친 경우를 복구하고, 리스너가 끊기면 큐 폴링으로 전환합니다.
+
+        Args:
+            prompt_id: 기다릴 프롬프트 ID
+
+        Returns:
+            bool: 실행 성공 여부
+        """
+        logger.info("실행 완료 대기 중...")
+
+        # 이미 이력에 기록된 프롬프트면 바로 완료 처리
+        if await self._history_ready(prompt_id):
+            logger.info("워크플로우 실행 완료!")
+            return True
+
+        loop = asyncio.get_running_loop()
+        waiter = self._ws_waiters.setdefault(prompt_id, loop.create_future())
+        self._ensure_ws_listener()
+
+        try:
+            while True:
+                if self._ws_listener is None or self._ws_listener.done():
+                    logger.warning("WebSocket 리스너 종료, 큐 폴링으로 대체합니다.")
+                    return await self._wait_by_polling(prompt_id)
+
+                try:
+                    await asyncio.wait_for(asyncio.shield(waiter), timeout=WS_RECHECK_INTERVAL)
+                    logger.info("워크플로우 실행 완료!")
+                    return True
+                except asyncio.TimeoutError:
+                    # 구독 전에 완료되어 이벤트가 오지 않는 경우를 대비해 이력 재확인
+                    if await self._history_ready(prompt_id):
+                        logger.info("워크플로우 실행 완료!")
+                        return True
+        finally:
+            self._ws_waiters.pop(prompt_id, None)
+
+    def _ensure_ws_listener(self) -> None:
+        """공유 WebSocket 리스너 태스크가 없거나 종료되었으면 새로 시작"""
+        if self._ws_listener is None or self._ws_listener.done():
+            self._ws_listener = asyncio.create_task(self._ws_listen())
+
+    async def _ws_listen(self) -> None:
+        """공유 WebSocket 연결에서 완료 이벤트를 수신해 대기자에게 분배
+
+        node가 None인 executing 이벤트가 해당 프롬프트의 실행 종료를
+        의미하므로, 등록된 프롬프트 ID의 future에 결과를 전달합니다.
+        연결이 끊기거나 오류가 나면 태스크가 종료되고, 대기자들은
+        이를 감지해 큐 폴링으로 전환합니다.
+        """
+        ws_address = self.server_address.replace("http", "ws", 1)
+        try:
+            async with self.session.ws_connect(f"{ws_address}/ws?clientId={self.client_id}") as ws:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+
+                    event = json.loads(msg.data)
+                    if event.get("type") != "executing":
+                        continue
+
+                    data = event.get("data", {})
+                    if data.get("node") is not None:
+                        continue
+
+                    waiter = self._ws_waiters.get(data.get("prompt_id"))
+                    if waiter is not None and not waiter.done():
+                        waiter.set_result(True)
+        except aiohttp.ClientError as e:
+            logger.warning("WebSocket 연결 실패: %s", e)
+
+    async def _wait_by_polling(self, prompt_id: str, min_delay: float = 0.2, max_delay: float = 5.0) -> bool:
+        """큐 상태를 주기적으로 조회하여 완료 대기 (WebSocket 대체 경로)
+
+        고정 간격 대신 지수 백오프를 사용합니다. 짧은 작업은 빠르게
+        감지하고, 긴 작업에서는 조회 간격을 점점 늘려 서버 부하를
+        줄입니다. 큐 내용이 바뀌면 간격을 다시 최소값으로 되돌립니다.
+
+        Args:
+            prompt_id: 기다릴 프롬프트 ID
+            min_delay: 최소 조회 간격(초)
+            max_delay: 최대 조회 간격(초)
+
+        Returns:
+            bool: 실행 성공 여부
+        """
+        delay = min_delay
+        last_queue_state = None
+        while True:
+            # 이력에 이미 기록되었으면 큐 조회 없이 완료 처리
+            # (서버 쪽에서 단일 키 조회라 큐 전체 파싱보다 훨씬 가벼움)
+            if await self._history_ready(prompt_id):
+                logger.info("워크플로우 실행 완료!")
+                return True
+
+            # 큐 상태 확인 (응답 본문은 스트리밍으로 파싱)
+            try:
+                async with self.session.get(f"{self.server_address}/queue") as response:
+                    if response.status != 200:
+                        logger.warning("큐 상태 확인 실패: %s", response.status)
+                        await asyncio.sleep(delay)
+                        delay = min(max_delay, delay * 1.5)
+                        continue
+
+                    found, running_prompts, pending_prompts = await self._scan_queue(
+                        response.content, prompt_id
+                    )
+            except ijson.JSONError as e:
+                # 스트리밍 파싱이 불가능한 응답이면 전체 JSON 파싱으로 대체
+                logger.warning("큐 응답 스트리밍 파싱 실패, 전체 파싱으로 대체합니다: %s", e)
+                running_prompts, pending_prompts = await self._fetch_queue_ids()
+                found = prompt_id in running_prompts or prompt_id in pending_prompts
+
+            # 매 틱 실행되는 경로이므로 DEBUG가 꺼져 있으면 문자열도 만들지 않음
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("실행 중인 작업: %s", running_prompts)
+                logger.debug("대기 중인 작업: %s", pending_prompts)
+
+            # 해당 프롬프트가 큐에 없고 처리 중인 작업도 없으면 완료로 간주
+            if not found and not running_prompts:
+                logger.info("워크플로우 실행 완료!")
+                return True
+
+            # 큐 내용이 바뀌었으면 조회 간격을 최소값으로 재설정
+            queue_state = (tuple(running_prompts), tuple(pending_prompts))
+            if queue_state != last_queue_state:
+                delay = min_delay
+                last_queue_state = queue_state
+
+            # 아직 완료되지 않았으면 대기 (간격을 점점 늘림)
+            await asyncio.sleep(delay)
+            delay = min(max_delay, delay * 1.5)
+
+    async def _history_ready(self, prompt_id: str) -> bool:
+        """프롬프트가 이미 이력에 기록되었는지 확인 (값싼 완료 검사)
+
+        ComfyUI는 실행이 끝나는 즉시 /history/{prompt_id}를 채우므로,
+        항목이 존재하면 완료로 판단할 수 있습니다. 확인 실패는 모두
+        미완료로 간주하여 호출 측의 일반 대기 경로로 넘깁니다.
+
+        Args:
+            prompt_id: 확인할 프롬프트 ID
+
+        Returns:
+            bool: 이력이 존재하면 True
+        """
+        try:
+            async with self.session.get(
+                f"{self.server_address}/history/{prompt_id}",
+                timeout=aiohttp.ClientTimeout(total=2),
+            ) as response:
+                if response.status != 200:
+                    return False
+                history = await response.json()
+            return bool(history)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def _scan_queue(self, body, prompt_id: str) -> Tuple[bool, List[str], List[str]]:
+        """큐 응답 본문을 스트리밍으로 파싱하여 프롬프트 ID만 추출
+
+        전체 큐 JSON을 파이썬 객체로 만들지 않고 ijson 이벤트 단위로
+        읽으면서 각 항목의 프롬프트 ID 문자열만 수집합니다. 찾는 ID가
+        나오면 나머지 본문은 읽지 않고 즉시 반환합니다.
+
+        Args:
+            body: 큐 응답 본문 스트림
+            prompt_id: 찾을 프롬프트 ID
+
+        Returns:
+            Tuple: (발견 여부, 실행 중인 ID 목록, 대기 중인 ID 목록)
+        """
+        running_prompts: List[str] = []
+        pending_prompts: List[str] = []
+
+        async for prefix, event, value in ijson.parse(body):
+            if event != "string":
+                continue
+            # 목록형 항목은 두 번째 열, 딕셔너리형 항목은 prompt_id 키가 프롬프트 ID
+            if prefix in ("queue_running.item.item", "queue_running.item.prompt_id"):
+                running_prompts.append(value)
+            elif prefix in ("queue_pending.item.item", "queue_pending.item.prompt_id"):
+                pending_prompts.append(value)
+            else:
+                continue
+
+            if value == prompt_id:
+                return True, running_prompts, pending_prompts
+
+        return False, running_prompts, pending_prompts
+
+    async def _fetch_queue_ids(self) -> Tuple[List[str], List[str]]:
+        """큐 전체 JSON을 받아 실행/대기 중인 프롬프트 ID 목록 추출 (스트리밍 대체 경로)
+
+        Returns:
+            Tuple: (실행 중인 ID 목록, 대기 중인 ID 목록)
+        """
+        async with self.session.get(f"{self.server_address}/queue") as response:
+            if response.status != 200:
+                raise Exception(f"큐 상태 확인 실패: {response.status}")
+
+            queue_data = await response.json()
+
+        running = queue_data.get("queue_running", [])
+        pending = queue_data.get("queue_pending", [])
+        running_prompts = self._extract_prompt_ids(running) if isinstance(running, list) else []
+        pending_prompts = self._extract_prompt_ids(pending) if isinstance(pending, list) else []
+
+        return running_prompts, pending_prompts
+
+    @staticmethod
+    def _extract_prompt_ids(entries: List[Any]) -> List[str]:
+        """큐 항목 목록에서 프롬프트 ID 추출
+
+        ComfyUI의 실제 큐 항목은 [priority, prompt_id, prompt, extra,
+        outputs_to_execute] 형태이므로 두 번째 열을 바로 읽습니다.
+        예상과 다른 구조를 만났을 때만 항목별로 형태를 확인하는
+        느린 경로로 내려갑니다.
+
+        Args:
+            entries: 큐 항목 목록 (queue_running 또는 queue_pending)
+
+        Returns:
+            List[str]: 추출된 프롬프트 ID 목록
+        """
+        try:
+            return [item["prompt_id"] if isinstance(item, dict) else item[1] for item in entries]
+        except (KeyError, IndexError, TypeError):
+            pass
+
+        # 알 수 없는 구조: 항목별 형태 검사로 추출
+        prompt_ids = []
+        for item in entries:
+            if isinstance(item, dict) and "prompt_id" in item:
+                prompt_ids.append(item["prompt_id"])
+            elif isinstance(item, list) and len(item) > 1:
+                prompt_ids.append(item[1])
+            elif isinstance(item, list) and item:
+                prompt_ids.append(item[0])
+        return prompt_ids
+
+    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        """특정 프롬프트의 실행 결과 이력 조회
+
+        /history/{prompt_id} 엔드포인트로 해당 항목만 조회하며,
+        결과는 캐시되어 같은 프롬프트를 다시 조회할 때 재사용됩니다.
+
+        Args:
+            prompt_id: 조회할 프롬프트 ID
+
+        Returns:
+            Dict: 이력 데이터
+        """
+        # 캐시 확인 (TTL 이내면 재조회 없이 반환)
+        cached = self._history_cache.get(prompt_id)
+        if cached is not None:
+            saved_at, entry = cached
+            if time.monotonic() - saved_at < HISTORY_CACHE_TTL:
+                return entry
+            del self._history_cache[prompt_id]
+
+        response = await self._request_with_retry("GET", f"{self.server_address}/history/{prompt_id}")
+        async with response:
+            if response.status != 200:
+                raise Exception(f"이력 조회 실패: {response.status}")
+
+            history = await response.json()
+        self.history_data.update(history)
+
+        if prompt_id in history:
+            entry = history[prompt_id]
+            self._history_cache[prompt_id] = (time.monotonic(), entry)
+            return entry
+        else:
+            logger.warning("경고: 프롬프트 ID %s에 대한 이력이 없습니다.", prompt_id)
+            return {}
+
+    async def download_images(self, prompt_id: str, output_dir: str = "output") -> List[str]:
+        """생성된 이미지 다운로드
+
+        Args:
+            prompt_id: 이미지를 생성한 프롬프트 ID
+            output_dir: 이미지를 저장할 디렉토리
+
+        Returns:
+            List[str]: 다운로드된 이미지 파일 경로 목록
+        """
+        # 이력 조회
+        history = await self.get_history(prompt_id)
+
+        if not history or "outputs" not in history:
+            logger.warning("경고: 프롬프트 ID %s에 대한 출력이 없습니다.", prompt_id)
+            return []
+
+        # 출력 디렉토리 생성
+        os.makedirs(output_dir, exist_ok=True)
+
+        # 다운로드할 (URL, 저장 경로) 목록을 먼저 수집
+        download_tasks = []
+        outputs = history.get("outputs", {})
+
+        for node_id, node_output in outputs.items():
+            for output_type, output_data in node_output.items():
+                if output_type == "images":
+                    for image_data in output_data:
+                        filename = image_data.get("filename", "")
+                        if filename:
+                            # 공백/유니코드 파일명을 위해 인코딩하고, 하위 폴더 출력도
+                            # 받을 수 있도록 subfolder와 type을 함께 전달
+                            query = urlencode({
+                                "filename": filename,
+                                "subfolder": image_data.get("subfolder", ""),
+                                "type": image_data.get("type", "output"),
+                            })
+                            image_url = f"{self._view_base}?{query}"
+                            local_path = os.path.join(output_dir, os.path.basename(filename))
+                            download_tasks.append((image_url, local_path))
+
+        # 수집한 이미지를 동시에 다운로드
+        results = await asyncio.gather(
+            *[self._fetch_image(url, path) for url, path in download_tasks]
+        )
+        downloaded_files = [path for path in results if path is not None]
+
+        return downloaded_files
+
+    async def _fetch_image(self, image_url: str, local_path: str) -> Optional[str]:
+        """이미지 하나를 다운로드하여 파일로 저장
+
+        Args:
+            image_url: 다운로드할 이미지 URL
+            local_path: 저장할 로컬 파일 경로
+
+        Returns:
+            Optional[str]: 성공 시 저장된 파일 경로, 실패 시 None
+        """
+        async with self.session.get(image_url) as response:
+            if response.status != 200:
+                logger.warning("이미지 다운로드 실패: %s, 상태 코드: %s", image_url, response.status)
+                return None
+
+            # 이미지 전체를 메모리에 올리지 않고 1MiB 단위로 파일에 바로 기록
+            with open(local_path, "wb") as file:
+                async for chunk in response.content.iter_chunked(1 << 20):
+                    file.write(chunk)
+
+        logger.info("이미지 다운로드 완료: %s", local_path)
+        return local_path
+
+
+async def collect_story_images(api: ComfyUIAPI, prompt_id: str, index: int, semaphore: asyncio.Semaphore) -> List[str]:
+    """이미 제출된 프롬프트의 완료를 기다렸다가 생성된 이미지 다운로드
+
+    Args:
+        api: ComfyUI API 클라이언트
+        prompt_id: 기다릴 프롬프트 ID
+        index: 스토리 번호 (0부터 시작)
+        semaphore: 동시 다운로드 개수를 제한하는 세마포어
+
+    Returns:
+        List[str]: 다운로드된 이미지 파일 경로 목록
+    """
+    # 완료 대기 (서버는 이 사이에도 다음 프롬프트를 계속 실행)
+    await api.wait_for_completion(prompt_id)
+
+    async with semaphore:
+        output_dir = f"output/story_{index+1}"
+        downloaded_files = await api.download_images(prompt_id, output_dir)
+
+        logger.info("스토리 %d 생성된 이미지: %d개", index + 1, len(downloaded_files))
+        for file in downloaded_files:
+            logger.info(" - %s", file)
+
+        return downloaded_files
+
+
+async def main():
+    # ComfyUI API 클라이언트 초기화 (세션은 컨텍스트 안에서만 유효)
+    async with ComfyUIAPI("http://127.0.0.1:8188") as api:  # 서버 주소 확인
+        logger.info("ComfyUI API 클라이언트가 초기화되었습니다.")
+
+        # 워크플로우 파일 경로 확인
+        workflow_path = "FluxAPi.json"
+        logger.info("워크플로우 파일 '%s' 로드 중...", workflow_path)
+
+        # 워크플로우 로드
+        try:
+            workflow = api.load_workflow(workflow_path)
+            logger.info("워크플로우 로드 성공!")
+        except Exception as e:
+            logger.error("워크플로우 로드 실패: %s", e)
+            logger.error("현재 작업 디렉토리: %s", os.getcwd())
+            logger.error("파일 존재 여부: %s", os.path.exists(workflow_path))
+            raise
+
+        # 테스트 실행을 위한 스토리 설명 목록
+        # stories 폴더 내 JSON 파일 로드
+        stories_folder = "stories"
+        story_descriptions = []
+
+        if os.path.exists(stories_folder) and os.path.isdir(stories_folder):
+            # scandir은 한 번의 시스템 호출로 엔트리와 타입 정보를 함께 가져옴
+            with os.scandir(stories_folder) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        try:
+                            # orjson은 bytes 입력을 받으므로 바이너리로 읽음
+                            with open(entry.path, "rb") as file:
+                                story_data = orjson.loads(file.read())
+                            if isinstance(story_data, dict) and "pages" in story_data:
+                                for page in story_data["pages"]:
+                                    if "image" in page:
+                                        story_descriptions.append(page["image"])
+                            else:
+                                logger.warning("경고: 파일 %s에 'pages' 키가 없거나 올바르지 않습니다.", entry.name)
+                        except Exception as e:
+                            logger.warning("파일 %s 로드 중 오류 발생: %s", entry.name, e)
+        else:
+            logger.warning("경고: '%s' 폴더가 존재하지 않습니다.", stories_folder)
+
+        if not story_descriptions:
+            logger.warning("처리할 스토리 설명이 없습니다.")
+            return
+
+        # 1단계: 모든 스토리의 프롬프트를 먼저 제출
+        # 서버 큐가 쉬지 않고 다음 작업을 이어서 실행하도록 제출을 몰아서 처리
+        logger.info("스토리 %d개 프롬프트 제출 중...", len(story_descriptions))
+        workflows = [
+            api.update_node_input(workflow, "32", "text", description)
+            for description in story_descriptions
+        ]
+        prompt_ids = await api.run_workflows_batch(workflows)
+
+        # 2단계: 완료된 프롬프트부터 이미지 다운로드 (GPU 실행과 다운로드 I/O가 겹침)
+        semaphore = asyncio.Semaphore(4)
+        tasks = [
+            collect_story_images(api, prompt_id, i, semaphore)
+            for i, prompt_id in enumerate(prompt_ids)
+        ]
+        results = await asyncio.gather(*tasks)
+
+        total = sum(len(files) for files in results)
+        logger.info("전체 스토리 %d개 처리 완료, 생성된 이미지 총 %d개", len(story_descriptions), total)
+
+
+# 메인 실행 코드
+if __name__ == "__main__":
+    # 줄 단위 flush를 피하도록 버퍼링된 스트림으로 로그 출력
+    log_stream = io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8", line_buffering=False)
+    logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.StreamHandler(log_stream)])
+
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        logger.exception("오류 발생: %s", e)
+    finally:
+        logging.shutdown()
+        log_stream.flush()